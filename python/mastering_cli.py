@@ -5,52 +5,208 @@ AI mastering CLI powered by ffmpeg/ffprobe.
 from __future__ import annotations
 
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
 import json
+import math
 import os
+import re
 import shutil
+import struct
 import subprocess
 import sys
+import threading
 from dataclasses import dataclass, asdict
 
+try:
+  # 任意依存: 入っていればffprobe/loudnorm JSONのパースが数倍速くなる
+  from orjson import loads as json_loads
+except ImportError:
+  json_loads = json.loads
+
+try:
+  # 任意依存: 揃っていればanalyzeをffmpeg子プロセスなしでインプロセス実行できる
+  import pyloudnorm
+  import soundfile
+except ImportError:
+  pyloudnorm = None
+  soundfile = None
+
+try:
+  # 任意依存: --render-engine=pyav でDSPチェーンをインプロセス実行できる
+  import av
+except ImportError:
+  av = None
+
 
 @dataclass
 class AudioMetrics:
   lufs: float | None
   truePeak: float | None
   crest: float | None
+  sampleRate: int | None = None
+  bitDepth: int | None = None
 
 
-def run_command(cmd: list[str]) -> str:
-  try:
-    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-    return result.stdout
-  except subprocess.CalledProcessError as e:
-    print(f"Command failed: {e.cmd}", file=sys.stderr)
-    print(f"STDOUT: {e.stdout}", file=sys.stderr)
-    print(f"STDERR: {e.stderr}", file=sys.stderr)
-    raise
+@functools.lru_cache(maxsize=None)
+def find_binary(name: str) -> str:
+  # PATH探索は呼び出し毎に行う必要がない
+  path = shutil.which(name)
+  if not path:
+    raise FileNotFoundError(f"{name} not found in PATH")
+  return path
 
 
-def get_loudness_metrics(file_path: str) -> AudioMetrics:
-  # loudnormを使って解析 (print_format=json)
-  cmd = [
-    'ffmpeg', '-i', file_path,
-    '-af', 'loudnorm=print_format=json',
-    '-f', 'null', '-'
-  ]
+# ffmpegバイナリは滅多に変わらないので、フィルタ有無のプローブ結果を
+# プロセスを跨いでディスクにキャッシュする (バイナリのパスとmtimeで無効化)。
+# /tmpは他ユーザーのファイルと衝突し偽キャッシュも読めてしまうため、
+# ユーザー毎のXDGキャッシュディレクトリに置く。
+_CAPS_CACHE_PATH = os.path.join(
+  os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+  'mastering_cli', 'ffmpeg_caps.json')
+_PROBE_FILTERS = ('ebur128', 'loudnorm', 'asplit', 'acompressor', 'alimiter')
+
 
+@functools.lru_cache(maxsize=1)
+def ffmpeg_capabilities() -> frozenset[str]:
+  binary = find_binary('ffmpeg')
   try:
-    # ffmpegのloudnorm解析結果はstderrに出力される
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    mtime = os.path.getmtime(binary)
+  except OSError:
+    mtime = 0.0
 
-    # stderrからJSON部分を抽出する
-    stderr_output = result.stderr
-    json_start = stderr_output.find('{')
-    json_end = stderr_output.rfind('}') + 1
+  try:
+    with open(_CAPS_CACHE_PATH, encoding='utf-8') as f:
+      cached = json.load(f)
+    if cached.get('binary') == binary and cached.get('mtime') == mtime:
+      return frozenset(cached['filters'])
+  except (OSError, ValueError, KeyError):
+    pass
+
+  result = subprocess.run(
+    [binary, '-hide_banner', '-filters'], capture_output=True, text=True)
+  available = set()
+  for line in result.stdout.splitlines():
+    parts = line.split()
+    if len(parts) >= 2:
+      available.add(parts[1])
+  caps = frozenset(name for name in _PROBE_FILTERS if name in available)
+
+  try:
+    os.makedirs(os.path.dirname(_CAPS_CACHE_PATH), exist_ok=True)
+    with open(_CAPS_CACHE_PATH, 'w', encoding='utf-8') as f:
+      json.dump({'binary': binary, 'mtime': mtime, 'filters': sorted(caps)}, f)
+  except OSError:
+    pass
+  return caps
+
+
+def _as_argv(cmd: list) -> list[str]:
+  # argvを素のstrに正規化する。PathLikeが混ざるとsubprocessが要素毎に
+  # os.fspath変換のフォールバック経路を通り、posix_spawnの高速パスを
+  # 外れる環境があるため、spawn前に一括で済ませておく。
+  return [arg if isinstance(arg, str) else str(os.fspath(arg)) for arg in cmd]
+
+
+# stderrはフレーム毎のprogress行で数MBに膨らむことがあるため、
+# 末尾のみ保持する (loudnorm JSONやエラーは末尾に出る)
+STDERR_TAIL_LINES = 4096
+
+
+# stdout→ファイル書き出しのチャンクサイズ
+WRITE_CHUNK_BYTES = 1 << 20
+
+
+def _finalize_wav_header(output_path: str) -> None:
+  # パイプ出力だとffmpegはRIFF/dataのサイズをプレースホルダのまま残すため、
+  # 確定したファイルサイズから埋め直す
+  total = os.path.getsize(output_path)
+  with open(output_path, 'r+b') as f:
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+      return
+    f.seek(4)
+    f.write(struct.pack('<I', (total - 8) & 0xFFFFFFFF))
+    offset = 12
+    while offset + 8 <= total:
+      f.seek(offset)
+      chunk = f.read(8)
+      chunk_id = chunk[:4]
+      chunk_size = struct.unpack('<I', chunk[4:])[0]
+      if chunk_id == b'data':
+        f.seek(offset + 4)
+        f.write(struct.pack('<I', (total - offset - 8) & 0xFFFFFFFF))
+        return
+      offset += 8 + chunk_size + (chunk_size & 1)
+
+
+def run_command_to_file(cmd: list[str], output_path: str) -> subprocess.CompletedProcess:
+  # ffmpegに直接ファイルを書かせず、stdoutのWAVストリームを専用スレッドで
+  # 書き出す。エンコードとディスク書き込みがオーバーラップし、遅いストレージの
+  # 書き込み待ちでffmpeg側が止まらなくなる。stderrは本スレッドでドレインする。
+  cmd = _as_argv(cmd)
+  proc = subprocess.Popen(
+    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    bufsize=WRITE_CHUNK_BYTES)
+  assert proc.stdout is not None and proc.stderr is not None
+
+  # 書き込み失敗をスレッド内で握り潰すとstdoutがドレインされず、パイプが
+  # 詰まってffmpegごとハングする。例外は保持しつつ残りを読み捨て、join後に
+  # 親スレッドで再送出する。
+  writer_error: list[Exception] = []
+
+  def _writer() -> None:
+    try:
+      with open(output_path, 'wb') as out:
+        shutil.copyfileobj(proc.stdout, out, WRITE_CHUNK_BYTES)
+    except Exception as e:
+      writer_error.append(e)
+      try:
+        while proc.stdout.read(WRITE_CHUNK_BYTES):
+          pass
+      except OSError:
+        pass
+
+  writer = threading.Thread(target=_writer, daemon=True)
+  writer.start()
+
+  tail: collections.deque[str] = collections.deque(maxlen=STDERR_TAIL_LINES)
+  for raw_line in proc.stderr:
+    tail.append(raw_line.decode(errors='replace'))
+  proc.wait()
+  writer.join()
+  stderr_tail = ''.join(tail)
+
+  if writer_error:
+    print(f"Failed to write output file: {output_path}: {writer_error[0]}", file=sys.stderr)
+    raise writer_error[0]
+
+  if proc.returncode != 0:
+    print(f"Command failed: {cmd}", file=sys.stderr)
+    print(f"STDERR: {stderr_tail}", file=sys.stderr)
+    raise subprocess.CalledProcessError(proc.returncode, cmd, '', stderr_tail)
+
+  _finalize_wav_header(output_path)
+  return subprocess.CompletedProcess(cmd, proc.returncode, '', stderr_tail)
+
+
+# loudnormの測定JSONは10行前後 (数百文字)。末尾スライスだけ走査すれば十分
+LOUDNORM_JSON_TAIL_CHARS = 4096
+
+
+def parse_loudnorm_json(stderr_output: str) -> AudioMetrics:
+  # stderrからJSON部分を抽出する (loudnormの測定結果は末尾に出力される)
+  # 全文をrfindで走査せず、有界の末尾スライスのみ対象にする
+  tail = stderr_output[-LOUDNORM_JSON_TAIL_CHARS:]
+  try:
+    json_start = tail.rfind('{')
+    json_end = tail.rfind('}') + 1
 
     if json_start != -1 and json_end != -1:
-      json_str = stderr_output[json_start:json_end]
-      data = json.loads(json_str)
+      json_str = tail[json_start:json_end]
+      data = json_loads(json_str)
 
       input_i = float(data.get('input_i', -99))
       input_tp = float(data.get('input_tp', -99))
@@ -66,8 +222,202 @@ def get_loudness_metrics(file_path: str) -> AudioMetrics:
   return AudioMetrics(lufs=None, truePeak=None, crest=None)
 
 
-def apply_mastering(input_path: str, output_path: str, args: argparse.Namespace):
-  filters = []
+# 測定専用のloudnorm (正規化はnull出力に捨てるので測定値だけ使う)
+MEASURE_FILTER = 'loudnorm=I=-14:TP=-1.0:LRA=9:print_format=json'
+
+# ebur128はloudnormの測定モードより約半分のCPUでI/TP/LRAを計算できる。
+# framelog=verboseでフレーム毎の行をinfoレベル未満に落とす (Summary:はinfoのまま)。
+# framelog=quietはffmpeg 5.1以降にしか無く、Dockerfileのffmpeg 4.3では
+# フィルタ初期化ごと失敗する。
+EBUR128_FILTER = 'ebur128=peak=true:framelog=verbose'
+
+# ebur128のSummary:ブロックからI(LUFS)とPeak(dBFS)を取り出す
+EBUR128_SUMMARY_RE = re.compile(
+  r"I:\s+(-?\d+\.\d+)\s+LUFS.*?Peak:\s+(-?\d+\.\d+)\s+dBFS", re.S)
+
+
+def parse_ebur128_summary(stderr_output: str) -> AudioMetrics:
+  match = EBUR128_SUMMARY_RE.search(stderr_output)
+  if not match:
+    print("Warning: Failed to parse ebur128 summary", file=sys.stderr)
+    return AudioMetrics(lufs=None, truePeak=None, crest=None)
+
+  lufs = float(match.group(1))
+  true_peak = float(match.group(2))
+  # クレストファクターの簡易計算 (Peak - RMSに近い値として)
+  return AudioMetrics(lufs=lufs, truePeak=true_peak, crest=true_peak - lufs)
+
+
+def ffmpeg_thread_args(ffmpeg_threads: int = 0) -> list[str]:
+  # 多くのビルドはフィルタグラフをシングルスレッドで実行するのが既定。
+  # -threads 0 でデコード並列化、-filter_threads でフィルタ毎のワーカーを確保する。
+  filter_threads = ffmpeg_threads if ffmpeg_threads > 0 else (os.cpu_count() or 4)
+  return [
+    '-threads', '0',
+    '-filter_threads', str(filter_threads),
+    '-filter_complex_threads', str(filter_threads),
+  ]
+
+
+# sample_fmt表記 (planarの's16p'等も含む) を1回のマッチで基本フォーマットに分解する
+_SAMPLE_FMT_RE = re.compile(r'^(u8|s16|s32|s64|flt|dbl)p?$')
+_SAMPLE_FMT_BITS = {'u8': 8, 's16': 16, 's32': 32, 's64': 64, 'flt': 32, 'dbl': 64}
+
+
+def base_sample_fmt(sample_fmt: str | None) -> str | None:
+  if not sample_fmt:
+    return None
+  match = _SAMPLE_FMT_RE.match(sample_fmt)
+  return match.group(1) if match else None
+
+
+def resolve_bit_depth(sample_fmt: str | None, bits_per_raw_sample: int | None = None) -> int | None:
+  # bits_per_raw_sampleがあれば最優先 (s32コンテナの24bit実体を区別できる)
+  if bits_per_raw_sample:
+    return bits_per_raw_sample
+  fmt = base_sample_fmt(sample_fmt)
+  return _SAMPLE_FMT_BITS[fmt] if fmt else None
+
+
+# ビット深度 → 出力PCMコーデック。不明時はこれまで通り24bitに倒す
+PCM_CODECS = {8: 'pcm_u8', 16: 'pcm_s16le', 24: 'pcm_s24le', 32: 'pcm_s32le'}
+
+# 浮動小数ソースはint PCMに落とすと0dBFS超がハードクリップするため、
+# 浮動小数PCMのまま書き出す
+FLOAT_PCM_CODECS = {'flt': 'pcm_f32le', 'dbl': 'pcm_f64le'}
+
+
+def parse_probe_json(stdout_output: str) -> tuple[int | None, int | None, str | None]:
+  # ffprobeのJSONから (sample_rate, bit_depth, base_fmt) を取り出す
+  try:
+    data = json_loads(stdout_output)
+    stream = data['streams'][0]
+    sample_rate = int(stream['sample_rate'])
+    sample_fmt = stream.get('sample_fmt')
+    bits_raw = int(stream.get('bits_per_raw_sample') or stream.get('bits_per_sample') or 0) or None
+    bit_depth = resolve_bit_depth(sample_fmt, bits_raw)
+    return sample_rate, bit_depth, base_sample_fmt(sample_fmt)
+  except Exception as e:
+    print(f"Warning: Failed to parse ffprobe output: {e}", file=sys.stderr)
+    return None, None, None
+
+
+async def probe_stream(file_path: str) -> tuple[int | None, int | None, str | None]:
+  # コンテナヘッダのみ読むので数十ms程度で終わる
+  cmd = [
+    find_binary('ffprobe'), '-v', 'error',
+    '-select_streams', 'a:0',
+    '-show_entries', 'stream=sample_rate,sample_fmt,bits_per_sample,bits_per_raw_sample',
+    '-of', 'json', file_path
+  ]
+  proc = await asyncio.create_subprocess_exec(
+    *_as_argv(cmd), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+  stdout, _ = await proc.communicate()
+  return parse_probe_json(stdout.decode())
+
+
+async def _read_stderr_tail(stream: asyncio.StreamReader) -> str:
+  # communicate()のような全量バッファを避け、同期側と同じ有界テールで受ける
+  tail: collections.deque[str] = collections.deque(maxlen=STDERR_TAIL_LINES)
+  while True:
+    line = await stream.readline()
+    if not line:
+      return ''.join(tail)
+    tail.append(line.decode(errors='replace'))
+
+
+async def _run_metric_measure(file_path: str, engine: str) -> AudioMetrics:
+  if engine == 'loudnorm':
+    measure_filter, parse = MEASURE_FILTER, parse_loudnorm_json
+  else:
+    measure_filter, parse = EBUR128_FILTER, parse_ebur128_summary
+
+  # 測定レポート(infoレベル)は必要なので-loglevel errorにはできない。
+  # -nostatsでフレーム毎のprogress行だけを落とす。
+  cmd = [
+    find_binary('ffmpeg'), '-hide_banner', '-nostats', *ffmpeg_thread_args(),
+    '-i', file_path,
+    '-af', measure_filter,
+    '-f', 'null', '-'
+  ]
+  # ffmpegの測定結果はstderrに出力される
+  proc = await asyncio.create_subprocess_exec(
+    *_as_argv(cmd), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+  assert proc.stderr is not None
+  stderr_tail = await _read_stderr_tail(proc.stderr)
+  returncode = await proc.wait()
+  if returncode != 0:
+    # 失敗をnull測定値として握り潰さず、非ゼロ終了として表面化させる
+    print(f"Command failed: {cmd}", file=sys.stderr)
+    print(f"STDERR: {stderr_tail}", file=sys.stderr)
+    raise subprocess.CalledProcessError(returncode, cmd, '', stderr_tail)
+  return parse(stderr_tail)
+
+
+# soundfileのsubtype表記 → ビット深度
+_SUBTYPE_BIT_DEPTH = {'PCM_16': 16, 'PCM_24': 24, 'PCM_32': 32, 'FLOAT': 32, 'DOUBLE': 64}
+
+
+def measure_in_process(file_path: str) -> AudioMetrics | None:
+  # pyloudnorm+soundfileがあればサブプロセス起動・再デコードなしで測定できる。
+  # 読めないコンテナ等はNoneを返してffmpeg経路にフォールバックする。
+  if pyloudnorm is None or soundfile is None:
+    return None
+  try:
+    data, rate = soundfile.read(file_path, always_2d=True)
+    meter = pyloudnorm.Meter(rate)
+    lufs = float(meter.integrated_loudness(data))
+
+    # 注: オーバーサンプリングなしのサンプルピーク (真のTPのわずかな下限近似)
+    peak = float(abs(data).max())
+    true_peak = 20 * math.log10(peak) if peak > 0 else None
+    crest = (true_peak - lufs) if true_peak is not None else None
+
+    info = soundfile.info(file_path)
+    return AudioMetrics(
+      lufs=lufs, truePeak=true_peak, crest=crest,
+      sampleRate=int(rate), bitDepth=_SUBTYPE_BIT_DEPTH.get(info.subtype))
+  except Exception as e:
+    print(f"Warning: in-process analysis failed, falling back to ffmpeg: {e}", file=sys.stderr)
+    return None
+
+
+async def get_loudness_metrics(file_path: str, engine: str = 'ebur128') -> AudioMetrics:
+  # 測定(全サンプルのデコード, 秒〜分単位)とffprobe(ヘッダのみ)は
+  # 独立したサブプロセスなので並行起動し、ffprobeのレイテンシを隠す
+  metrics, (sample_rate, bit_depth, _) = await asyncio.gather(
+    _run_metric_measure(file_path, engine),
+    probe_stream(file_path),
+  )
+  metrics.sampleRate = sample_rate
+  metrics.bitDepth = bit_depth
+  return metrics
+
+
+# alimiterのlimitは線形振幅で、有効範囲は0.0625〜1.0
+ALIMITER_LIMIT_MIN = 0.0625
+ALIMITER_LIMIT_MAX = 1.0
+
+
+def db_to_amplitude(db: float) -> float:
+  # 10 ** (db / 20)。math.powはint分岐のない浮動小数専用パスで僅かに速い
+  return math.pow(10.0, db / 20.0)
+
+
+# build_filter_chainの定数断片。呼び出し毎に文字列を組み直すのは可変部分だけに
+# する。先頭でサンプルフォーマットをdblpに固定するのは、biquad(equalizer)・
+# acompressor・alimiterがいずれもdouble系で動き、段間の自動aresample変換を
+# 消すため。
+CHAIN_HEAD = 'aformat=sample_fmts=dblp'
+EQ_FRAGMENT = 'equalizer=frequency={hz}:width_type=q:width={q}:gain={db}'
+COMP_FRAGMENT = 'acompressor=threshold={th}dB:ratio={ratio}:attack={att}:release={rel}'
+LIMITER_FRAGMENT = 'alimiter=limit={limit:.6f}:attack=5:release={rel}'
+LOUDNORM_FRAGMENT = 'loudnorm=I={lufs}:TP={tp}'
+RESAMPLE_FRAGMENT = 'aresample={rate}'
+
+
+def build_filter_chain(args: argparse.Namespace, source_rate: int | None = None) -> str:
+  filters = [CHAIN_HEAD]
 
   # 1. Input Trim (属性アクセスの安全な書き方に修正)
   trim_db = getattr(args, "input_trim_db", None)
@@ -79,14 +429,14 @@ def apply_mastering(input_path: str, output_path: str, args: argparse.Namespace)
   eq_low_db = getattr(args, "eq_low_db", None)
   eq_low_q = getattr(args, "eq_low_q", None)
   if eq_low_hz and eq_low_db and eq_low_q:
-    filters.append(f"eq=frequency={eq_low_hz}:width_type=q:width={eq_low_q}:gain={eq_low_db}")
+    filters.append(EQ_FRAGMENT.format(hz=eq_low_hz, q=eq_low_q, db=eq_low_db))
 
   # 3. EQ High
   eq_high_hz = getattr(args, "eq_high_hz", None)
   eq_high_db = getattr(args, "eq_high_db", None)
   eq_high_q = getattr(args, "eq_high_q", None)
   if eq_high_hz and eq_high_db and eq_high_q:
-    filters.append(f"eq=frequency={eq_high_hz}:width_type=q:width={eq_high_q}:gain={eq_high_db}")
+    filters.append(EQ_FRAGMENT.format(hz=eq_high_hz, q=eq_high_q, db=eq_high_db))
 
   # 4. Compressor
   comp_th = getattr(args, "comp_threshold", None)
@@ -99,7 +449,7 @@ def apply_mastering(input_path: str, output_path: str, args: argparse.Namespace)
     # defaults: attack=20, release=250 (ffmpeg uses ms)
     att = comp_att if comp_att else 20
     rel = comp_rel if comp_rel else 250
-    filters.append(f"acompressor=threshold={comp_th}dB:ratio={comp_ratio}:attack={att}:release={rel}")
+    filters.append(COMP_FRAGMENT.format(th=comp_th, ratio=comp_ratio, att=att, rel=rel))
 
   # 5. Limiter (alimiter)
   lim_ceil = getattr(args, "limiter_ceiling", None)
@@ -107,25 +457,180 @@ def apply_mastering(input_path: str, output_path: str, args: argparse.Namespace)
   if lim_ceil:
     # attack is usually auto, release in ms
     lim_rel = getattr(args, "limiter_release", 100)
-    filters.append(f"alimiter=limit={lim_ceil}:attack=5:release={lim_rel}")
+    # シーリングはdB指定で渡ってくるので、alimiterが要求する線形振幅へ変換し
+    # 有効範囲にクランプする
+    limit = min(max(db_to_amplitude(lim_ceil), ALIMITER_LIMIT_MIN), ALIMITER_LIMIT_MAX)
+    filters.append(LIMITER_FRAGMENT.format(limit=limit, rel=lim_rel))
 
   # 6. Loudness Normalization (Target LUFS) - Optional finish
   target_lufs = getattr(args, "target_lufs", None)
   true_peak = getattr(args, "true_peak", None)
 
   if target_lufs and true_peak:
-    filters.append(f"loudnorm=I={target_lufs}:TP={true_peak}")
-
-  filter_str = ",".join(filters) if filters else "anull"
+    filters.append(LOUDNORM_FRAGMENT.format(lufs=target_lufs, tp=true_peak))
+    # 単パスloudnormは以降のグラフを192kHzに固定するため、ソースレートへ
+    # 戻してから書き出す (出力サイズも約4倍に膨らまない)
+    if source_rate:
+      filters.append(RESAMPLE_FRAGMENT.format(rate=source_rate))
+
+  return ",".join(filters)
+
+
+def apply_mastering(input_path: str, output_path: str, args: argparse.Namespace) -> AudioMetrics:
+  # 出力フォーマットはソースのビット深度に合わせる (16bitソースを24bitに
+  # 膨らませて書き込み量を1.5倍にしない)。レートはチェーン構築にも使う
+  # (loudnorm後のaresample)のでプローブを先に済ませる。
+  source_rate, source_depth, source_fmt = asyncio.run(probe_stream(input_path))
+  filter_str = build_filter_chain(args, source_rate)
+
+  if source_fmt in FLOAT_PCM_CODECS:
+    codec = FLOAT_PCM_CODECS[source_fmt]
+    output_depth = source_depth
+  else:
+    output_depth = source_depth if source_depth in PCM_CODECS else 24
+    codec = PCM_CODECS[output_depth]
+
+  if getattr(args, 'render_engine', 'ffmpeg') == 'pyav':
+    if render_with_pyav(input_path, output_path, filter_str, codec):
+      # PyAVグラフには測定ブランチを含めていないため、出力を別途測定する
+      metrics = measure_in_process(output_path)
+      if metrics is None:
+        engine = 'ebur128' if 'ebur128' in ffmpeg_capabilities() else 'loudnorm'
+        metrics = asyncio.run(get_loudness_metrics(output_path, engine))
+      return metrics
+
+  # マスタリングと測定を1パスに融合する:
+  # マスター済み信号をasplitで分岐し、片方をファイルへ、もう片方を
+  # loudnorm測定(null出力)へ流す。出力ファイルの再デコードが不要になる。
+  filter_graph = (
+    f"[0:a]{filter_str},asplit=2[out][mtap];"
+    f"[mtap]{MEASURE_FILTER}[measured]"
+  )
 
   cmd = [
-    'ffmpeg', '-y', '-i', input_path,
-    '-af', filter_str,
-    output_path
+    find_binary('ffmpeg'), '-hide_banner', '-nostats', '-y',
+    *ffmpeg_thread_args(getattr(args, 'ffmpeg_threads', 0)),
+    '-i', input_path,
+    '-filter_complex', filter_graph,
+    '-map', '[out]', '-c:a', codec, '-f', 'wav', 'pipe:1',
+    '-map', '[measured]', '-f', 'null', '-'
   ]
 
   print(f"Executing FFmpeg: {' '.join(cmd)}", file=sys.stderr)
-  run_command(cmd)
+  result = run_command_to_file(cmd, output_path)
+  metrics = parse_loudnorm_json(result.stderr)
+  # 出力のレートはソースと同じ (loudnorm使用時はaresampleで戻している)、
+  # ビット深度は選択したコーデックで確定している。書き上がったファイルへの
+  # 追いffprobeは不要。プローブ失敗時はsource_rateがNoneでレート不明のまま。
+  metrics.sampleRate = source_rate
+  metrics.bitDepth = output_depth
+  return metrics
+
+
+def render_with_pyav(input_path: str, output_path: str, filter_str: str, codec: str) -> bool:
+  # デコード→フィルタ→エンコードを同一プロセスのlibavフィルタグラフで完結させ、
+  # 子プロセス起動とstdoutパイプ越しのフレームコピーを省く。
+  # avが無い/失敗した場合はFalseを返してsubprocess経路にフォールバックする。
+  if av is None:
+    return False
+  try:
+    with av.open(input_path) as in_container:
+      in_stream = in_container.streams.audio[0]
+
+      graph = av.filter.Graph()
+      nodes = [graph.add_abuffer(template=in_stream)]
+      # チェーンは "name=args" のカンマ結合 (args内にカンマは現れない)
+      for spec in filter_str.split(','):
+        name, _, filter_args = spec.partition('=')
+        nodes.append(graph.add(name, filter_args or None))
+      nodes.append(graph.add('abuffersink'))
+      for upstream, downstream in zip(nodes, nodes[1:]):
+        upstream.link_to(downstream)
+      graph.configure()
+
+      with av.open(output_path, 'w') as out_container:
+        out_stream = out_container.add_stream(codec, rate=in_stream.rate)
+
+        def _drain() -> None:
+          while True:
+            try:
+              filtered = graph.pull()
+            except (av.BlockingIOError, av.EOFError):
+              return
+            for packet in out_stream.encode(filtered):
+              out_container.mux(packet)
+
+        for frame in in_container.decode(in_stream):
+          graph.push(frame)
+          _drain()
+        graph.push(None)  # EOFを流してフィルタ内部の遅延分を吐き出させる
+        _drain()
+        for packet in out_stream.encode(None):
+          out_container.mux(packet)
+    return True
+  except Exception as e:
+    print(f"Warning: PyAV render failed, falling back to ffmpeg: {e}", file=sys.stderr)
+    return False
+
+
+# サーバー側のALLOWED_UPLOAD_EXTENSIONSと揃えておく
+AUDIO_EXTENSIONS = {'.wav', '.wave', '.aiff', '.aif', '.mp3', '.flac'}
+
+
+def master_single_file(input_path: str, output_path: str, args: argparse.Namespace) -> dict:
+  # ProcessPoolExecutorのワーカー。1ファイル失敗してもバッチ全体は止めない
+  try:
+    metrics = apply_mastering(input_path, output_path, args)
+    return {"input": input_path, "output": output_path, "finalMetrics": asdict(metrics)}
+  except Exception as e:
+    return {"input": input_path, "output": output_path, "error": str(e)}
+
+
+def run_batch(args: argparse.Namespace) -> list[dict]:
+  inputs = sorted(
+    entry.path for entry in os.scandir(args.input_dir)
+    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS)
+  os.makedirs(args.output_dir, exist_ok=True)
+
+  # ffmpeg自体がスレッド化されているので、既定はコア数の半分に抑える
+  jobs = args.jobs or max(1, (os.cpu_count() or 4) // 2)
+
+  results = []
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+    futures = {}
+    for input_path in inputs:
+      stem = os.path.splitext(os.path.basename(input_path))[0]
+      output_path = os.path.join(args.output_dir, f"{stem}.wav")
+      futures[pool.submit(master_single_file, input_path, output_path, args)] = input_path
+    for future in concurrent.futures.as_completed(futures):
+      results.append(future.result())
+
+  results.sort(key=lambda r: r['input'])
+  return results
+
+
+def add_mastering_params(parser: argparse.ArgumentParser) -> None:
+  # Mastering params (master/batch共通)
+  parser.add_argument('--target-lufs', type=float)
+  parser.add_argument('--true-peak', type=float)
+  parser.add_argument('--input-trim-db', type=float)
+  parser.add_argument('--comp-threshold', type=float)
+  parser.add_argument('--comp-ratio', type=float)
+  parser.add_argument('--attack', type=float)
+  parser.add_argument('--release', type=float)
+  parser.add_argument('--eq-low-hz', type=float)
+  parser.add_argument('--eq-low-db', type=float)
+  parser.add_argument('--eq-low-q', type=float)
+  parser.add_argument('--eq-high-hz', type=float)
+  parser.add_argument('--eq-high-db', type=float)
+  parser.add_argument('--eq-high-q', type=float)
+  parser.add_argument('--limiter-ceiling', type=float)
+  parser.add_argument('--limiter-lookahead', type=float)
+  parser.add_argument('--limiter-release', type=float)
+  parser.add_argument('--platform', type=str)
+  parser.add_argument('--profile-name', type=str)
+  parser.add_argument('--ffmpeg-threads', type=int, default=0)
+  parser.add_argument('--render-engine', choices=['ffmpeg', 'pyav'], default='ffmpeg')
 
 
 def main():
@@ -135,44 +640,47 @@ def main():
   # Analyze command
   p_analyze = subparsers.add_parser('analyze')
   p_analyze.add_argument('input_file')
+  p_analyze.add_argument(
+    '--metric-engine', choices=['auto', 'native', 'ebur128', 'loudnorm'], default='auto')
 
   # Master command
   p_master = subparsers.add_parser('master')
   p_master.add_argument('input_file')
   p_master.add_argument('output_file')
+  add_mastering_params(p_master)
 
-  # Mastering params
-  p_master.add_argument('--target-lufs', type=float)
-  p_master.add_argument('--true-peak', type=float)
-  p_master.add_argument('--input-trim-db', type=float)
-  p_master.add_argument('--comp-threshold', type=float)
-  p_master.add_argument('--comp-ratio', type=float)
-  p_master.add_argument('--attack', type=float)
-  p_master.add_argument('--release', type=float)
-  p_master.add_argument('--eq-low-hz', type=float)
-  p_master.add_argument('--eq-low-db', type=float)
-  p_master.add_argument('--eq-low-q', type=float)
-  p_master.add_argument('--eq-high-hz', type=float)
-  p_master.add_argument('--eq-high-db', type=float)
-  p_master.add_argument('--eq-high-q', type=float)
-  p_master.add_argument('--limiter-ceiling', type=float)
-  p_master.add_argument('--limiter-lookahead', type=float)
-  p_master.add_argument('--limiter-release', type=float)
-  p_master.add_argument('--platform', type=str)
-  p_master.add_argument('--profile-name', type=str)
+  # Batch command (ディレクトリ一括処理)
+  p_batch = subparsers.add_parser('batch')
+  p_batch.add_argument('input_dir')
+  p_batch.add_argument('output_dir')
+  p_batch.add_argument('--jobs', type=int, default=0)
+  add_mastering_params(p_batch)
 
   args = parser.parse_args()
 
   if args.mode == 'analyze':
-    metrics = get_loudness_metrics(args.input_file)
+    engine = args.metric_engine
+    metrics = None
+    if engine in ('auto', 'native'):
+      # インプロセス測定が使えればサブプロセス起動を丸ごと省略できる
+      metrics = measure_in_process(args.input_file)
+      engine = 'ebur128'
+    if metrics is None:
+      if engine == 'ebur128' and 'ebur128' not in ffmpeg_capabilities():
+        print("Warning: ebur128 filter unavailable, falling back to loudnorm", file=sys.stderr)
+        engine = 'loudnorm'
+      metrics = asyncio.run(get_loudness_metrics(args.input_file, engine))
     print(json.dumps({"metrics": asdict(metrics)}))
 
   elif args.mode == 'master':
-    apply_mastering(args.input_file, args.output_file, args)
-    # マスタリング後の再測定
-    final_metrics = get_loudness_metrics(args.output_file)
+    # 測定はレンダリングと同一パスで行われる (再デコード不要)
+    final_metrics = apply_mastering(args.input_file, args.output_file, args)
     print(json.dumps({"finalMetrics": asdict(final_metrics)}))
 
+  elif args.mode == 'batch':
+    results = run_batch(args)
+    print(json.dumps({"results": results}))
+
 
 if __name__ == '__main__':
   main()